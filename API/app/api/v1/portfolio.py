@@ -2,14 +2,26 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
 from app.db.database import get_db
 from app.api.v1.auth import get_current_user
-from app.models.models import User, Holding, StockMeta, KisKey
-from app.services.portfolio_service import sync_user_portfolio
+from app.models.models import User, Holding, StockMeta
+from app.services.portfolio_service import (
+    sync_user_portfolio,
+    build_kis_key_rows,
+    upsert_kis_keys,
+    replace_kis_keys,
+    delete_kis_key,
+    build_stock_meta_rows,
+    upsert_stock_metas,
+    apply_target_hits
+)
 
 router = APIRouter(prefix="/portfolio", tags=["portfolio"])
 
+# Keeps a batch upsert well below asyncpg's 32767 bind parameter limit
+MAX_BATCH_SIZE = 500
+
 # Schemas
 class KisKeyCreate(BaseModel):
     app_key: str
@@ -23,6 +35,9 @@ class StockMetaSchema(BaseModel):
     target_price: Optional[float] = None
     tags: Optional[str] = None
 
+class StockMetaPatch(StockMetaSchema):
+    stock_code: str
+
 class HoldingResponse(BaseModel):
     stock_code: str
     stock_name: str
@@ -36,26 +51,24 @@ class HoldingResponse(BaseModel):
 
 @router.post("/keys")
 async def register_keys(keys: KisKeyCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    # Check if exists
-    stmt = select(KisKey).where(KisKey.user_id == current_user.id)
-    existing = (await db.execute(stmt)).scalars().first()
-    
-    if existing:
-        existing.app_key = keys.app_key
-        existing.app_secret = keys.app_secret
-        existing.account_no = keys.account_no
-        existing.account_prod = keys.account_prod
-        existing.is_virtual = keys.is_virtual
-    else:
-        new_key = KisKey(
-            user_id=current_user.id,
-            **keys.dict()
-        )
-        db.add(new_key)
-    
-    await db.commit()
+    # Replaces all of the user's keys with this one (use /keys/batch for several accounts)
+    await replace_kis_keys(current_user.id, {"user_id": current_user.id, **keys.dict()}, db)
     return {"message": "Keys registered successfully"}
 
+@router.post("/keys/batch")
+async def register_keys_batch(keys: conlist(KisKeyCreate, max_length=MAX_BATCH_SIZE), current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Multi-account registration: one row per (account_no, account_prod), written in a single upsert
+    rows, results = build_kis_key_rows(current_user.id, keys)
+    await upsert_kis_keys(rows, db)
+    return {"message": f"{len(rows)} key(s) registered", "results": results}
+
+@router.delete("/keys/{account_no}")
+async def delete_keys(account_no: str, account_prod: str = "01", current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    deleted = await delete_kis_key(current_user.id, account_no, account_prod, db)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Key not found")
+    return {"message": "Key deleted"}
+
 @router.post("/sync")
 async def sync_portfolio(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     await sync_user_portfolio(current_user.id, db)
@@ -96,22 +109,18 @@ async def get_holdings(current_user: User = Depends(get_current_user), db: Async
 
 @router.post("/stocks/{code}/meta")
 async def update_stock_meta(code: str, meta: StockMetaSchema, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    stmt = select(StockMeta).where(StockMeta.user_id == current_user.id, StockMeta.stock_code == code)
-    existing = (await db.execute(stmt)).scalars().first()
-    
-    if existing:
-        if meta.note is not None: existing.note = meta.note
-        if meta.target_price is not None: existing.target_price = meta.target_price
-        if meta.tags is not None: existing.tags = meta.tags
-    else:
-        new_meta = StockMeta(
-            user_id=current_user.id,
-            stock_code=code,
-            note=meta.note,
-            target_price=meta.target_price,
-            tags=meta.tags
-        )
-        db.add(new_meta)
-        
-    await db.commit()
+    rows, results = build_stock_meta_rows(current_user.id, [StockMetaPatch(stock_code=code, **meta.dict())])
+    if results[0]["status"] != "ok":
+        raise HTTPException(status_code=400, detail=results[0]["detail"])
+
+    await upsert_stock_metas(current_user.id, rows, db)
     return {"message": "Meta updated"}
+
+@router.post("/stocks/meta/batch")
+async def update_stock_meta_batch(patches: conlist(StockMetaPatch, max_length=MAX_BATCH_SIZE), current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Same patch semantics as update_stock_meta (None keeps the stored value),
+    # but every patch is applied with one upsert in one transaction.
+    rows, results = build_stock_meta_rows(current_user.id, patches)
+    alerts = await upsert_stock_metas(current_user.id, rows, db)
+    apply_target_hits(results, alerts)
+    return {"message": f"{len(rows)} meta(s) updated", "results": results, "alerts": alerts}
@@ -11,3 +11,67 @@ Base = declarative_base()
 async def get_db():
     async with SessionLocal() as session:
         yield session
+
+# create_all does not touch tables that already exist, so the schema changes
+# the upserts rely on are applied here. Each block checks the catalog first and
+# only does work (backfill, dedupe, ALTER) while the change is still missing.
+SCHEMA_MIGRATIONS = [
+    # kis_keys.account_prod: NULLs never collide in a UNIQUE constraint,
+    # so backfill the Python-side default and forbid NULLs.
+    """
+    DO $$ BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = 'kis_keys'::regclass AND attname = 'account_prod' AND NOT attnotnull
+    ) THEN
+        UPDATE kis_keys SET account_prod = '01' WHERE account_prod IS NULL;
+        ALTER TABLE kis_keys ALTER COLUMN account_prod SET NOT NULL;
+    END IF;
+    END $$
+    """,
+    # One key per account; the newest duplicate wins.
+    """
+    DO $$ BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'uq_kis_keys_user_account' AND conrelid = 'kis_keys'::regclass
+    ) THEN
+        DELETE FROM kis_keys a USING kis_keys b
+        WHERE a.user_id = b.user_id AND a.account_no = b.account_no
+          AND a.account_prod = b.account_prod AND a.id < b.id;
+        ALTER TABLE kis_keys ADD CONSTRAINT uq_kis_keys_user_account UNIQUE (user_id, account_no, account_prod);
+    END IF;
+    END $$
+    """,
+    # One meta per stock. Duplicates are merged into the newest row first:
+    # each field keeps the newest non-NULL value, as a COALESCE patch would.
+    """
+    DO $$ BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'uq_stock_metas_user_stock' AND conrelid = 'stock_metas'::regclass
+    ) THEN
+        UPDATE stock_metas k
+        SET note = m.note, target_price = m.target_price, tags = m.tags
+        FROM (
+            SELECT
+                max(id) AS keep_id,
+                (array_agg(note ORDER BY id DESC) FILTER (WHERE note IS NOT NULL))[1] AS note,
+                (array_agg(target_price ORDER BY id DESC) FILTER (WHERE target_price IS NOT NULL))[1] AS target_price,
+                (array_agg(tags ORDER BY id DESC) FILTER (WHERE tags IS NOT NULL))[1] AS tags
+            FROM stock_metas
+            GROUP BY user_id, stock_code
+            HAVING count(*) > 1
+        ) m
+        WHERE k.id = m.keep_id;
+        DELETE FROM stock_metas a USING stock_metas b
+        WHERE a.user_id = b.user_id AND a.stock_code = b.stock_code AND a.id < b.id;
+        ALTER TABLE stock_metas ADD CONSTRAINT uq_stock_metas_user_stock UNIQUE (user_id, stock_code);
+    END IF;
+    END $$
+    """,
+]
+
+async def ensure_unique_constraints(conn):
+    for migration in SCHEMA_MIGRATIONS:
+        await conn.exec_driver_sql(migration)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, Text, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, Text, JSON, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.db.database import Base
@@ -18,13 +18,17 @@ class User(Base):
 
 class KisKey(Base):
     __tablename__ = "kis_keys"
+    __table_args__ = (
+        # One row per account; upsert target for batch key registration
+        UniqueConstraint("user_id", "account_no", "account_prod", name="uq_kis_keys_user_account"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     app_key = Column(String, nullable=False)
     app_secret = Column(String, nullable=False)
     account_no = Column(String, nullable=False)  # First 8 digits
-    account_prod = Column(String, default="01") # Last 2 digits
+    account_prod = Column(String, nullable=False, default="01") # Last 2 digits
     is_virtual = Column(Boolean, default=False) # True for VPS (Virtual), False for Real
     htsid = Column(String, nullable=True) # For WebSocket
     
@@ -57,6 +61,10 @@ class StockPriceHistory(Base):
 
 class StockMeta(Base):
     __tablename__ = "stock_metas"
+    __table_args__ = (
+        # Upsert target for batch meta updates
+        UniqueConstraint("user_id", "stock_code", name="uq_stock_metas_user_stock"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -1,88 +1,256 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from app.models.models import User, KisKey, Holding, StockPriceHistory
+from sqlalchemy import select, delete, func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.models.models import User, KisKey, Holding, StockPriceHistory, StockMeta
 from app.utils.kis_api import KisApi
 import logging
 
 logger = logging.getLogger(__name__)
 
+def aggregate_holdings(holdings_lists):
+    # Holding has no account column, so positions of the same stock held in
+    # several accounts are merged: quantities are summed and avg_price is
+    # weighted by quantity.
+    aggregated = {}
+    for holdings_list in holdings_lists:
+        for item in holdings_list:
+            code = item.get("pdno") # Product Number (Stock Code)
+            qty = int(item.get("hldg_qty", 0))
+            if qty == 0:
+                continue
+
+            avg_price = float(item.get("pchs_avg_pric", 0))
+            current_price = float(item.get("prpr", 0)) # Current Price from balance query
+
+            entry = aggregated.get(code)
+            if entry is None:
+                aggregated[code] = {
+                    "stock_name": item.get("prdt_name"),
+                    "quantity": qty,
+                    "avg_price": avg_price,
+                    "current_price": current_price
+                }
+            else:
+                total_qty = entry["quantity"] + qty
+                entry["avg_price"] = (entry["avg_price"] * entry["quantity"] + avg_price * qty) / total_qty
+                entry["quantity"] = total_qty
+                entry["current_price"] = current_price
+    return aggregated
+
 async def sync_user_portfolio(user_id: int, db: AsyncSession):
-    # 1. Get User's KIS Keys
-    result = await db.execute(select(KisKey).where(KisKey.user_id == user_id))
-    kis_key = result.scalars().first()
-    
-    if not kis_key:
+    # 1. Get User's KIS Keys (one per registered account)
+    result = await db.execute(select(KisKey).where(KisKey.user_id == user_id).order_by(KisKey.id))
+    kis_keys = result.scalars().all()
+
+    if not kis_keys:
         logger.warning(f"No KIS Key found for user {user_id}")
         return
-    
-    # 2. Initialize API
-    # Note: kis_key.account_no should be 8 digits. 
+
+    # 2. Fetch Balance of every account
+    # Note: kis_key.account_no should be 8 digits.
     # If we stored full account number, we might need to slice it.
     # Assuming the model stores 8 digits in account_no.
-    
-    api = KisApi(
-        app_key=kis_key.app_key,
-        app_secret=kis_key.app_secret,
-        account_no=kis_key.account_no,
-        account_prod=kis_key.account_prod,
-        is_virtual=kis_key.is_virtual
-    )
-    
-    # 3. Fetch Balance
-    try:
-        balance_data = await api.get_account_balance()
-    except Exception as e:
-        logger.error(f"Failed to fetch balance for user {user_id}: {e}")
-        return
+    holdings_lists = []
+    for kis_key in kis_keys:
+        api = KisApi(
+            app_key=kis_key.app_key,
+            app_secret=kis_key.app_secret,
+            account_no=kis_key.account_no,
+            account_prod=kis_key.account_prod,
+            is_virtual=kis_key.is_virtual
+        )
 
-    # Check for API error
-    if balance_data.get("rt_cd") != "0":
-        logger.error(f"API Error: {balance_data.get('msg1')}")
-        return
+        # A failed account aborts the whole sync; writing the others alone
+        # would store partial totals for stocks held in several accounts.
+        try:
+            balance_data = await api.get_account_balance()
+        except Exception as e:
+            logger.error(f"Failed to fetch balance for user {user_id} account {kis_key.account_no}, skipping sync (remove stale accounts via DELETE /portfolio/keys): {e}")
+            return
 
-    # 4. Process Holdings
-    # output1 is the list of holdings
-    holdings_list = balance_data.get("output1", [])
-    
-    for item in holdings_list:
-        code = item.get("pdno") # Product Number (Stock Code)
-        name = item.get("prdt_name")
-        qty = int(item.get("hldg_qty", 0))
-        if qty == 0:
-            continue
-            
-        avg_price = float(item.get("pchs_avg_pric", 0))
-        current_price = float(item.get("prpr", 0)) # Current Price from balance query
-        
+        # Check for API error
+        if balance_data.get("rt_cd") != "0":
+            logger.error(f"API Error for user {user_id} account {kis_key.account_no}, skipping sync (remove stale accounts via DELETE /portfolio/keys): {balance_data.get('msg1')}")
+            return
+
+        # output1 is the list of holdings
+        holdings_list = balance_data.get("output1", [])
+        holdings_lists.append(holdings_list)
+
+    # 3. Process Holdings
+    for code, item in aggregate_holdings(holdings_lists).items():
         # Upsert Holding
         # Check if holding exists
         stmt = select(Holding).where(Holding.user_id == user_id, Holding.stock_code == code)
         existing = (await db.execute(stmt)).scalars().first()
-        
+
         if existing:
-            existing.quantity = qty
-            existing.avg_price = avg_price
-            existing.current_price = current_price
-            # updated_at is auto-handled by onupdate=func.now() usually, but explicit touch might be safer if values didn't change? 
+            existing.quantity = item["quantity"]
+            existing.avg_price = item["avg_price"]
+            existing.current_price = item["current_price"]
+            # updated_at is auto-handled by onupdate=func.now() usually, but explicit touch might be safer if values didn't change?
             # SQLAlchemy detects changes.
         else:
             new_holding = Holding(
                 user_id=user_id,
                 stock_code=code,
-                stock_name=name,
-                quantity=qty,
-                avg_price=avg_price,
-                current_price=current_price
+                stock_name=item["stock_name"],
+                quantity=item["quantity"],
+                avg_price=item["avg_price"],
+                current_price=item["current_price"]
             )
             db.add(new_holding)
-        
-        # 5. Record Price History
+
+        # 4. Record Price History
         # We record the price at this sync time
         price_history = StockPriceHistory(
             stock_code=code,
-            price=current_price
+            price=item["current_price"]
         )
         db.add(price_history)
-        
+
     await db.commit()
-    logger.info(f"Synced portfolio for user {user_id}")
+    logger.info(f"Synced portfolio for user {user_id} ({len(kis_keys)} account(s))")
+
+
+def build_kis_key_rows(user_id: int, keys):
+    # Validates key registrations and returns (rows to upsert, per-item results).
+    # Later entries for the same account win; the earlier ones are reported
+    # as "superseded" since they are not written.
+    results = []
+    rows = {}
+    latest = {}
+    for key in keys:
+        result = {"account_no": key.account_no, "account_prod": key.account_prod}
+        if not (key.account_no.isdigit() and len(key.account_no) == 8):
+            results.append({**result, "status": "error", "detail": "account_no must be 8 digits"})
+            continue
+        if not (key.account_prod.isdigit() and len(key.account_prod) == 2):
+            results.append({**result, "status": "error", "detail": "account_prod must be 2 digits"})
+            continue
+
+        account = (key.account_no, key.account_prod)
+        if account in latest:
+            results[latest[account]]["status"] = "superseded"
+        latest[account] = len(results)
+        rows[account] = {"user_id": user_id, **key.dict()}
+        results.append({**result, "status": "ok"})
+    return list(rows.values()), results
+
+def build_kis_key_upsert(rows):
+    stmt = pg_insert(KisKey).values(rows)
+    return stmt.on_conflict_do_update(
+        constraint="uq_kis_keys_user_account",
+        set_={
+            "app_key": stmt.excluded.app_key,
+            "app_secret": stmt.excluded.app_secret,
+            "is_virtual": stmt.excluded.is_virtual
+        }
+    )
+
+async def upsert_kis_keys(rows, db: AsyncSession):
+    if rows:
+        await db.execute(build_kis_key_upsert(rows))
+    await db.commit()
+
+async def replace_kis_keys(user_id: int, row, db: AsyncSession):
+    # Single-key registration keeps its original meaning: the posted account
+    # becomes the user's only key, in one transaction.
+    await db.execute(delete(KisKey).where(
+        KisKey.user_id == user_id,
+        or_(KisKey.account_no != row["account_no"], KisKey.account_prod != row["account_prod"])
+    ))
+    await upsert_kis_keys([row], db)
+
+async def delete_kis_key(user_id: int, account_no: str, account_prod: str, db: AsyncSession):
+    result = await db.execute(delete(KisKey).where(
+        KisKey.user_id == user_id,
+        KisKey.account_no == account_no,
+        KisKey.account_prod == account_prod
+    ))
+    await db.commit()
+    return result.rowcount
+
+
+def build_stock_meta_rows(user_id: int, patches):
+    # Validates meta patches and returns (rows to upsert, per-item results).
+    # Repeated codes are merged so the upsert never touches the same row twice;
+    # a None field means "keep the stored value".
+    results = []
+    rows = {}
+    for patch in patches:
+        code = patch.stock_code.strip()
+        if not code:
+            results.append({"stock_code": patch.stock_code, "status": "error", "detail": "stock_code is required"})
+            continue
+        if patch.target_price is not None and patch.target_price < 0:
+            results.append({"stock_code": code, "status": "error", "detail": "target_price must not be negative"})
+            continue
+
+        row = rows.setdefault(code, {
+            "user_id": user_id,
+            "stock_code": code,
+            "note": None,
+            "target_price": None,
+            "tags": None
+        })
+        if patch.note is not None: row["note"] = patch.note
+        if patch.target_price is not None: row["target_price"] = patch.target_price
+        if patch.tags is not None: row["tags"] = patch.tags
+        results.append({"stock_code": code, "status": "ok"})
+    return list(rows.values()), results
+
+def build_stock_meta_upsert(rows):
+    stmt = pg_insert(StockMeta).values(rows)
+    return stmt.on_conflict_do_update(
+        constraint="uq_stock_metas_user_stock",
+        set_={
+            "note": func.coalesce(stmt.excluded.note, StockMeta.note),
+            "target_price": func.coalesce(stmt.excluded.target_price, StockMeta.target_price),
+            "tags": func.coalesce(stmt.excluded.tags, StockMeta.tags)
+        }
+    )
+
+async def upsert_stock_metas(user_id: int, rows, db: AsyncSession):
+    # Writes all rows and evaluates their target alerts in one transaction.
+    alerts = []
+    if rows:
+        await db.execute(build_stock_meta_upsert(rows))
+        alerts = await evaluate_target_alerts(user_id, db, [row["stock_code"] for row in rows])
+    await db.commit()
+    return alerts
+
+
+def build_target_alert_query(user_id: int, stock_codes=None):
+    # Compare every target price against the last synced price in a single query
+    # instead of loading each StockMeta/Holding pair separately.
+    stmt = select(
+        StockMeta.stock_code,
+        StockMeta.target_price,
+        Holding.current_price
+    ).join(
+        Holding,
+        (Holding.stock_code == StockMeta.stock_code) & (Holding.user_id == StockMeta.user_id)
+    ).where(
+        StockMeta.user_id == user_id,
+        StockMeta.target_price.is_not(None),
+        Holding.current_price.is_not(None),
+        Holding.current_price >= StockMeta.target_price
+    )
+    if stock_codes is not None:
+        stmt = stmt.where(StockMeta.stock_code.in_(stock_codes))
+    return stmt
+
+async def evaluate_target_alerts(user_id: int, db: AsyncSession, stock_codes=None):
+    results = await db.execute(build_target_alert_query(user_id, stock_codes))
+    return [
+        {"stock_code": code, "target_price": target_price, "current_price": current_price}
+        for code, target_price, current_price in results
+    ]
+
+def apply_target_hits(results, alerts):
+    hit_codes = {alert["stock_code"] for alert in alerts}
+    for result in results:
+        if result["status"] == "ok":
+            result["target_hit"] = result["stock_code"] in hit_codes
+    return results
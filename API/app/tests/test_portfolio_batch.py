@@ -0,0 +1,204 @@
+import asyncio
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.api.v1.router import api_router
+from app.api.v1.auth import get_current_user
+from app.api.v1.portfolio import KisKeyCreate, StockMetaPatch, MAX_BATCH_SIZE
+from app.db.database import get_db
+from app.models.models import User, KisKey, Holding, StockPriceHistory
+from app.services import portfolio_service
+from app.services.portfolio_service import (
+    aggregate_holdings,
+    build_kis_key_rows,
+    build_stock_meta_rows,
+    apply_target_hits,
+    sync_user_portfolio
+)
+
+# These tests cover the parts of the batch endpoints and the sync that do not
+# need a running database. Behaviour of the SQL itself is covered by
+# test_portfolio_db.py.
+
+def make_key(account_no="12345678", account_prod="01", app_key="key"):
+    return KisKeyCreate(app_key=app_key, app_secret="secret", account_no=account_no, account_prod=account_prod)
+
+def make_balance_item(code, qty, avg_price, current_price):
+    return {"pdno": code, "prdt_name": code, "hldg_qty": str(qty), "pchs_avg_pric": str(avg_price), "prpr": str(current_price)}
+
+
+def test_stock_meta_rows_merge_repeated_codes():
+    rows, results = build_stock_meta_rows(1, [
+        StockMetaPatch(stock_code="005930", note="first", target_price=70000),
+        StockMetaPatch(stock_code="000660", tags="chip"),
+        StockMetaPatch(stock_code=" 005930 ", note="second", tags="core"),
+    ])
+
+    assert rows == [
+        {"user_id": 1, "stock_code": "005930", "note": "second", "target_price": 70000, "tags": "core"},
+        {"user_id": 1, "stock_code": "000660", "note": None, "target_price": None, "tags": "chip"},
+    ]
+    assert [r["stock_code"] for r in results] == ["005930", "000660", "005930"]
+    assert all(r["status"] == "ok" for r in results)
+
+def test_stock_meta_rows_validation_errors():
+    rows, results = build_stock_meta_rows(1, [
+        StockMetaPatch(stock_code="  ", note="x"),
+        StockMetaPatch(stock_code="005930", target_price=-1),
+        StockMetaPatch(stock_code="000660", target_price=0),
+    ])
+
+    assert [row["stock_code"] for row in rows] == ["000660"]
+    assert results[0] == {"stock_code": "  ", "status": "error", "detail": "stock_code is required"}
+    assert results[1] == {"stock_code": "005930", "status": "error", "detail": "target_price must not be negative"}
+    assert results[2] == {"stock_code": "000660", "status": "ok"}
+
+def test_kis_key_rows_per_item_results():
+    rows, results = build_kis_key_rows(1, [
+        make_key(app_key="old"),
+        make_key(account_no="1234"),
+        make_key(account_prod="1"),
+        make_key(account_no="87654321"),
+        make_key(app_key="new"),
+    ])
+
+    assert [(r["account_no"], r["app_key"]) for r in rows] == [("12345678", "new"), ("87654321", "key")]
+    assert [r["status"] for r in results] == ["superseded", "error", "error", "ok", "ok"]
+    assert results[1]["detail"] == "account_no must be 8 digits"
+    assert results[2]["detail"] == "account_prod must be 2 digits"
+
+def test_apply_target_hits():
+    results = [
+        {"stock_code": "005930", "status": "ok"},
+        {"stock_code": "000660", "status": "ok"},
+        {"stock_code": "", "status": "error", "detail": "stock_code is required"},
+    ]
+    apply_target_hits(results, [{"stock_code": "005930", "target_price": 70000, "current_price": 71000}])
+
+    assert results[0]["target_hit"] is True
+    assert results[1]["target_hit"] is False
+    assert "target_hit" not in results[2]
+
+def test_aggregate_holdings_across_accounts():
+    aggregated = aggregate_holdings([
+        [make_balance_item("005930", 10, 60000, 70000)],
+        [make_balance_item("005930", 30, 80000, 70000), make_balance_item("000660", 0, 0, 0)],
+    ])
+
+    assert aggregated == {
+        "005930": {"stock_name": "005930", "quantity": 40, "avg_price": 75000.0, "current_price": 70000.0}
+    }
+
+
+class FakeResult:
+    def __init__(self, items):
+        self.items = items
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.items
+
+    def first(self):
+        return self.items[0] if self.items else None
+
+class FakeSession:
+    # Answers the key lookup with the given keys and every Holding lookup with
+    # "not found"; records what the sync adds and whether it commits.
+    def __init__(self, keys):
+        self.keys = keys
+        self.added = []
+        self.commits = 0
+
+    async def execute(self, stmt):
+        if stmt.column_descriptions[0]["entity"] is KisKey:
+            return FakeResult(self.keys)
+        return FakeResult([])
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    async def commit(self):
+        self.commits += 1
+
+def stub_kis_api(monkeypatch, balances):
+    # balances: account_no -> balance response, or an exception to raise
+    class StubKisApi:
+        def __init__(self, app_key, app_secret, account_no, account_prod="01", is_virtual=False):
+            self.account_no = account_no
+
+        async def get_account_balance(self):
+            balance = balances[self.account_no]
+            if isinstance(balance, Exception):
+                raise balance
+            return balance
+
+    monkeypatch.setattr(portfolio_service, "KisApi", StubKisApi)
+
+def make_kis_keys(*account_nos):
+    return [
+        KisKey(id=i, user_id=1, app_key="k", app_secret="s", account_no=no, account_prod="01", is_virtual=False)
+        for i, no in enumerate(account_nos, start=1)
+    ]
+
+def test_sync_merges_all_accounts(monkeypatch):
+    stub_kis_api(monkeypatch, {
+        "11111111": {"rt_cd": "0", "output1": [make_balance_item("005930", 10, 60000, 70000)]},
+        "22222222": {"rt_cd": "0", "output1": [make_balance_item("005930", 30, 80000, 70000)]},
+    })
+    db = FakeSession(make_kis_keys("11111111", "22222222"))
+
+    asyncio.run(sync_user_portfolio(1, db))
+
+    holdings = [obj for obj in db.added if isinstance(obj, Holding)]
+    history = [obj for obj in db.added if isinstance(obj, StockPriceHistory)]
+    assert [(h.stock_code, h.quantity, h.avg_price) for h in holdings] == [("005930", 40, 75000.0)]
+    assert [(p.stock_code, p.price) for p in history] == [("005930", 70000.0)]
+    assert db.commits == 1
+
+def test_sync_skips_commit_when_one_account_fails(monkeypatch):
+    stub_kis_api(monkeypatch, {
+        "11111111": {"rt_cd": "0", "output1": [make_balance_item("005930", 10, 60000, 70000)]},
+        "22222222": RuntimeError("account closed"),
+    })
+    db = FakeSession(make_kis_keys("11111111", "22222222"))
+
+    asyncio.run(sync_user_portfolio(1, db))
+
+    assert db.added == []
+    assert db.commits == 0
+
+def test_sync_skips_commit_on_api_error(monkeypatch):
+    stub_kis_api(monkeypatch, {
+        "11111111": {"rt_cd": "1", "msg1": "invalid account"},
+        "22222222": {"rt_cd": "0", "output1": [make_balance_item("005930", 10, 60000, 70000)]},
+    })
+    db = FakeSession(make_kis_keys("11111111", "22222222"))
+
+    asyncio.run(sync_user_portfolio(1, db))
+
+    assert db.added == []
+    assert db.commits == 0
+
+
+def make_client():
+    app = FastAPI()
+    app.include_router(api_router, prefix="/api/v1")
+    app.dependency_overrides[get_current_user] = lambda: User(id=1, username="tester")
+    app.dependency_overrides[get_db] = lambda: None
+    return TestClient(app)
+
+def test_batch_endpoints_reject_oversized_body():
+    client = make_client()
+    patches = [{"stock_code": f"{i:06d}"} for i in range(MAX_BATCH_SIZE + 1)]
+    keys = [{"app_key": "k", "app_secret": "s", "account_no": f"{i:08d}"} for i in range(MAX_BATCH_SIZE + 1)]
+
+    assert client.post("/api/v1/portfolio/stocks/meta/batch", json=patches).status_code == 422
+    assert client.post("/api/v1/portfolio/keys/batch", json=keys).status_code == 422
+
+def test_single_meta_endpoint_rejects_invalid_item():
+    client = make_client()
+
+    response = client.post("/api/v1/portfolio/stocks/005930/meta", json={"target_price": -1})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "target_price must not be negative"
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from app.db.database import Base, ensure_unique_constraints
+from app.models.models import User, KisKey, Holding, StockMeta
+from app.services.portfolio_service import (
+    build_stock_meta_rows,
+    upsert_stock_metas,
+    build_kis_key_rows,
+    upsert_kis_keys,
+    replace_kis_keys,
+    delete_kis_key,
+    apply_target_hits
+)
+from app.api.v1.portfolio import KisKeyCreate, StockMetaPatch
+
+# Runs the upserts and the startup migration against a real PostgreSQL.
+# The tables of the target database are dropped and recreated.
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+def run_with_db(scenario):
+    async def runner():
+        engine = create_async_engine(TEST_DATABASE_URL)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+                await conn.run_sync(Base.metadata.create_all)
+            async with AsyncSession(engine) as db:
+                db.add(User(id=1, username="tester", hashed_password="x"))
+                await db.commit()
+                await scenario(engine, db)
+        finally:
+            await engine.dispose()
+    asyncio.run(runner())
+
+def make_key(account_no, app_key="key"):
+    return KisKeyCreate(app_key=app_key, app_secret="secret", account_no=account_no)
+
+async def load_metas(db):
+    db.expire_all()
+    metas = (await db.execute(select(StockMeta).order_by(StockMeta.stock_code))).scalars().all()
+    return {m.stock_code: (m.note, m.target_price, m.tags) for m in metas}
+
+async def load_accounts(db):
+    db.expire_all()
+    keys = (await db.execute(select(KisKey).order_by(KisKey.account_no))).scalars().all()
+    return [(k.account_no, k.app_key) for k in keys]
+
+
+def test_meta_upsert_keeps_stored_values_for_none():
+    async def scenario(engine, db):
+        rows, _ = build_stock_meta_rows(1, [StockMetaPatch(stock_code="005930", note="memo", target_price=70000)])
+        await upsert_stock_metas(1, rows, db)
+        rows, _ = build_stock_meta_rows(1, [
+            StockMetaPatch(stock_code="005930", tags="core"),
+            StockMetaPatch(stock_code="000660", note="new"),
+        ])
+        await upsert_stock_metas(1, rows, db)
+
+        assert await load_metas(db) == {
+            "000660": ("new", None, None),
+            "005930": ("memo", 70000, "core"),
+        }
+    run_with_db(scenario)
+
+def test_meta_upsert_reports_target_hits():
+    async def scenario(engine, db):
+        db.add_all([
+            Holding(user_id=1, stock_code="005930", stock_name="A", quantity=1, avg_price=1, current_price=71000),
+            Holding(user_id=1, stock_code="000660", stock_name="B", quantity=1, avg_price=1, current_price=100000),
+            Holding(user_id=1, stock_code="035420", stock_name="C", quantity=1, avg_price=1, current_price=None),
+        ])
+        await db.commit()
+
+        rows, results = build_stock_meta_rows(1, [
+            StockMetaPatch(stock_code="005930", target_price=70000),
+            StockMetaPatch(stock_code="000660", target_price=150000),
+            StockMetaPatch(stock_code="035420", target_price=1),
+        ])
+        alerts = await upsert_stock_metas(1, rows, db)
+        apply_target_hits(results, alerts)
+
+        assert [a["stock_code"] for a in alerts] == ["005930"]
+        assert [r["target_hit"] for r in results] == [True, False, False]
+    run_with_db(scenario)
+
+def test_single_key_registration_replaces_other_accounts():
+    async def scenario(engine, db):
+        rows, _ = build_kis_key_rows(1, [make_key("11111111"), make_key("22222222")])
+        await upsert_kis_keys(rows, db)
+        assert await load_accounts(db) == [("11111111", "key"), ("22222222", "key")]
+
+        await replace_kis_keys(1, {"user_id": 1, **make_key("22222222", app_key="fixed").dict()}, db)
+        assert await load_accounts(db) == [("22222222", "fixed")]
+    run_with_db(scenario)
+
+def test_delete_key():
+    async def scenario(engine, db):
+        rows, _ = build_kis_key_rows(1, [make_key("11111111"), make_key("22222222")])
+        await upsert_kis_keys(rows, db)
+
+        assert await delete_kis_key(1, "11111111", "01", db) == 1
+        assert await delete_kis_key(1, "11111111", "01", db) == 0
+        assert await load_accounts(db) == [("22222222", "key")]
+    run_with_db(scenario)
+
+def test_migration_merges_legacy_duplicates_and_is_repeatable():
+    async def scenario(engine, db):
+        # Recreate the pre-constraint schema with the duplicates it allowed
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("ALTER TABLE stock_metas DROP CONSTRAINT uq_stock_metas_user_stock")
+            await conn.exec_driver_sql("ALTER TABLE kis_keys DROP CONSTRAINT uq_kis_keys_user_account")
+            await conn.exec_driver_sql("ALTER TABLE kis_keys ALTER COLUMN account_prod DROP NOT NULL")
+            await conn.exec_driver_sql(
+                "INSERT INTO kis_keys (user_id, app_key, app_secret, account_no, account_prod, is_virtual) VALUES "
+                "(1, 'old', 's', '11111111', NULL, false), (1, 'new', 's', '11111111', '01', false)"
+            )
+            await conn.exec_driver_sql(
+                "INSERT INTO stock_metas (user_id, stock_code, note, target_price, tags) VALUES "
+                "(1, '005930', 'old note', 70000, NULL), (1, '005930', NULL, NULL, 'core'), "
+                "(1, '005930', 'new note', NULL, NULL)"
+            )
+
+        for _ in range(2):
+            async with engine.begin() as conn:
+                await ensure_unique_constraints(conn)
+
+        assert await load_accounts(db) == [("11111111", "new")]
+        assert await load_metas(db) == {"005930": ("new note", 70000, "core")}
+
+        # The constraint is back, so the upsert target exists again
+        rows, _ = build_stock_meta_rows(1, [StockMetaPatch(stock_code="005930", tags="updated")])
+        await upsert_stock_metas(1, rows, db)
+        assert await load_metas(db) == {"005930": ("new note", 70000, "updated")}
+    run_with_db(scenario)
@@ -12,9 +12,10 @@ async def lifespan(app: FastAPI):
     print("Application startup")
     
     # Initialize DB Tables
-    from app.db.database import engine, Base
+    from app.db.database import engine, Base, ensure_unique_constraints
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await ensure_unique_constraints(conn)
         
     start_scheduler()
     yield